@@ -1,68 +1,460 @@
 """Plotting and visualization tools."""
 # stdlib
+import gzip
+import itertools
 import logging
+import os
+import re
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from typing import Literal
 
 # external
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
+from plotly.subplots import make_subplots
+
+# project
+from plot.libs import lttblib
 
 LOG = logging.getLogger(__name__)
 
 
-def style_to_matplotlib(fig) -> go.Figure:
+def _save_prefix() -> str:
+    """Builds the filename prefix of the figures saved by the current process.
+
+    Returns:
+        Timestamp followed by the process id, which keeps processes started within
+        the same second apart.
+
+    """
+    return f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{os.getpid()}"
+
+
+# saved figure filenames share a per-process prefix and a running counter
+_SAVE_PREFIX = _save_prefix()
+_SAVE_COUNTER = itertools.count()
+
+# saved figures are compressed and written to disk in the background
+_SAVE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plot-save")
+
+
+def _reset_save_state():
+    """Resets the save state in a forked child process.
+
+    The child inherits the filename prefix and counter of the parent, which would
+    have both processes save to the same filenames, and the executor of the parent
+    but not its worker thread, so figures submitted to it would never be written.
+
+    """
+    global _SAVE_PREFIX, _SAVE_COUNTER, _SAVE_EXECUTOR  # pylint: disable=global-statement
+    _SAVE_PREFIX = _save_prefix()
+    _SAVE_COUNTER = itertools.count()
+    _SAVE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="plot-save")
+
+
+os.register_at_fork(after_in_child=_reset_save_state)
+
+# directories already created by save
+_ENSURED_DIRS: set[Path] = set()
+
+# number of points above which 2D traces are rendered with WebGL rather than SVG
+WEBGL_THRESHOLD = 1000
+
+# matplotlib-like figure style, also registered as the "mpl_like" template
+_MPL_FONT = dict(family="Arial", size=26, color="black")
+_MPL_MARGIN = dict(r=20, t=20, b=10)  # remove white space
+_MPL_AXIS = dict(
+    showline=True,  # add line at x=0 / y=0
+    linecolor="black",  # line color
+    linewidth=2.4,  # line size
+    ticks="outside",  # ticks outside axis
+    tickfont=_MPL_FONT,  # tick label font
+    mirror="allticks",  # add ticks to top/right axes
+    tickwidth=2.4,  # tick width
+    tickcolor="black",  # tick color
+)
+_MPL_XAXIS = dict(_MPL_AXIS, showticklabels=True)  # show tick labels
+_MPL_LAYOUT = dict(
+    font=_MPL_FONT,  # font formatting
+    plot_bgcolor="white",  # background color
+    width=850,  # figure width
+    height=700,  # figure height
+    margin=_MPL_MARGIN,
+)
+
+pio.templates["mpl_like"] = go.layout.Template(
+    layout=dict(_MPL_LAYOUT, xaxis=_MPL_XAXIS, yaxis=_MPL_AXIS)
+)
+
+# layout keys of the 2D axes, e.g. xaxis, yaxis2
+_AXIS_KEY = re.compile(r"[xy]axis\d*")
+
+
+def _merge_style(props: dict, style: dict) -> dict:
+    """Merges style properties into layout properties.
+
+    Nested properties (e.g. fonts) are merged rather than replaced, as with
+    update_layout.
+
+    Args:
+        props: layout properties.
+        style: style properties taking precedence over the layout properties.
+
+    Returns:
+        The merged properties.
+
+    """
+    merged = dict(props)
+    for name, value in style.items():
+        merged[name] = (
+            {**props.get(name, {}), **value} if isinstance(value, dict) else value
+        )
+
+    return merged
+
+
+def style_to_matplotlib(fig, inplace: bool = False) -> go.Figure:
     """Style a plotly figure as a matplotlib figure.
 
     Args:
         fig: Plotly figure object to be styled.
+        inplace: whether to style the figure itself rather than a copy. Only styling
+            in place avoids copying the trace data, which dominates the cost for
+            large figures.
+
+    Returns:
+        The styled figure.
+
+    """
+    # the style is merged into the layout dictionary and validated once, rather than
+    # validating an update of every axis of every subplot
+    layout = _merge_style(props=fig.layout.to_plotly_json(), style=_MPL_LAYOUT)
+    for key in {"xaxis", "yaxis", *filter(_AXIS_KEY.fullmatch, layout)}:
+        axis_style = _MPL_XAXIS if key.startswith("x") else _MPL_AXIS
+        layout[key] = _merge_style(props=layout.get(key, {}), style=axis_style)
+
+    if inplace:
+        fig.layout = layout
+        return fig
+
+    # the copy still copies all trace data, but skips the additional dictionary
+    # round trip of go.Figure(fig)
+    return go.Figure(data=fig.data, layout=layout, frames=fig.frames)
+
+
+def _extract_columns(df, names: Iterable[str]) -> dict[str, np.ndarray]:
+    """Extracts columns of a dataframe as numpy arrays.
+
+    Pandas dataframes are indexed directly. Any other dataframe implementing the
+    dataframe interchange protocol (e.g. polars, pyarrow) is converted through arrow,
+    selecting only the requested columns so that the full frame is never
+    materialized.
+
+    Args:
+        df: dataframe containing data down columns.
+        names: column names to extract.
+
+    Returns:
+        Mapping of column name to column data.
+
+    """
+    names = list(dict.fromkeys(names))  # drop duplicates, keep order
+
+    if isinstance(df, pd.DataFrame):
+        return {name: df[name].to_numpy() for name in names}
+
+    # optional dependency, only required for non-pandas dataframes
+    # external
+    from pyarrow import interchange  # pylint: disable=import-outside-toplevel
+
+    table = interchange.from_dataframe(df.__dataframe__().select_columns_by_name(names))
+
+    return {name: table.column(name).to_numpy() for name in names}
+
+
+def _to_pandas(df, names: Iterable[str]) -> pd.DataFrame:
+    """Converts a dataframe to pandas for use with plotly express.
+
+    Args:
+        df: dataframe containing data down columns.
+        names: column names required by the plot.
+
+    Returns:
+        The dataframe itself if already a pandas dataframe, otherwise a pandas
+        dataframe holding only the requested columns.
 
     """
-    fig_styled = go.Figure(fig)
-
-    # choose the figure font
-    font_dict = dict(family="Arial", size=26, color="black")
-
-    # general figure formatting
-    fig_styled.update_layout(
-        font=font_dict,  # font formatting
-        plot_bgcolor="white",  # background color
-        width=850,  # figure width
-        height=700,  # figure height
-        margin=dict(r=20, t=20, b=10),  # remove white space
+    if isinstance(df, pd.DataFrame):
+        return df
+
+    return pd.DataFrame(data=_extract_columns(df=df, names=names))
+
+
+def _names(*names: str | list[str]) -> list[str]:
+    """Flattens column name arguments into a single list.
+
+    Args:
+        names: column name(s). None entries are ignored.
+
+    Returns:
+        List of column names.
+
+    """
+    flat = []
+    for name in names:
+        if isinstance(name, str):
+            flat.append(name)
+        elif name is not None:
+            flat.extend(name)
+
+    return flat
+
+
+def _render_mode(df: pd.DataFrame) -> str:
+    """Selects the plotly express render mode of a dataframe.
+
+    Args:
+        df: dataframe to be plotted.
+
+    Returns:
+        "webgl" if the dataframe exceeds the WebGL threshold, "svg" otherwise.
+
+    """
+    return "webgl" if len(df) > WEBGL_THRESHOLD else "svg"
+
+
+def _downsample(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray | slice:
+    """Selects the points of a series to be plotted.
+
+    Series longer than max_points are downsampled using the
+    largest-triangle-three-buckets algorithm. Non-numeric series are never
+    downsampled.
+
+    Args:
+        x: x-coordinates of the series.
+        y: y-coordinates of the series.
+        max_points: maximum number of points to keep. None keeps all points.
+
+    Returns:
+        Index of the points to be plotted.
+
+    """
+    if max_points is None or x.size <= max_points:
+        return slice(None)
+
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype(np.int64)
+
+    if not (np.issubdtype(x.dtype, np.number) and np.issubdtype(y.dtype, np.number)):
+        return slice(None)
+
+    return lttblib.lttb(x=x, y=y, n_out=max_points)
+
+
+def _base_layout(template: str) -> dict:
+    """Resolves a named template into a layout dictionary.
+
+    Serializing the registered template is several times cheaper than having plotly
+    look up and validate the named template for every figure. The template is
+    resolved on every call, so changes to registered templates are respected.
+
+    Args:
+        template: name of the figure template.
+
+    Returns:
+        Layout dictionary holding only the template.
+
+    """
+    return dict(template=pio.templates[template].to_plotly_json())
+
+
+def _xy_traces(
+    columns: dict[str, np.ndarray],
+    x: str,
+    ys: list[str],
+    mode: str,
+    x_error: str = None,
+    y_error: str = None,
+    max_points: int = None,
+    colors: list[str] = None,
+    showlegend: bool = False,
+) -> list[go.Scatter | go.Scattergl]:
+    """Builds one 2D trace per y column.
+
+    Args:
+        columns: mapping of column name to column data.
+        x: column name to treat as x coordinates of traces.
+        ys: column names to treat as y coordinates of traces.
+        mode: trace drawing mode.
+        x_error: column name to treat as x error of traces.
+        y_error: column name to treat as y error of traces.
+        max_points: maximum number of points per trace. None keeps all points.
+        colors: color of each trace. None leaves coloring to the template.
+        showlegend: whether to show the traces in the legend.
+
+    Returns:
+        The traces.
+
+    """
+    x_data = columns[x]
+
+    traces = []
+    for i, name in enumerate(ys):
+        index = _downsample(x=x_data, y=columns[name], max_points=max_points)
+        x_trace = x_data[index]
+        color = None if colors is None else colors[i % len(colors)]
+
+        trace_type = go.Scattergl if x_trace.size > WEBGL_THRESHOLD else go.Scatter
+
+        traces.append(
+            trace_type(
+                x=x_trace,
+                y=columns[name][index],
+                mode=mode,
+                name=name,
+                legendgroup=name,
+                showlegend=showlegend,
+                line_color=color,
+                marker_color=color,
+                error_x=None
+                if x_error is None
+                else dict(array=columns[x_error][index]),
+                error_y=None
+                if y_error is None
+                else dict(array=columns[y_error][index]),
+            )
+        )
+
+    return traces
+
+
+def _xy_figure(
+    columns: dict[str, np.ndarray],
+    x: str,
+    y: str | list[str],
+    mode: str,
+    fc: str = None,
+    fr: str = None,
+    x_error: str = None,
+    y_error: str = None,
+    title: str = None,
+    template: str = None,
+    max_points: int = None,
+) -> go.Figure:
+    """Builds a 2D figure directly from column arrays.
+
+    Bypasses plotly express' dataframe preprocessing for the case where no column
+    needs to be mapped onto a color, size or symbol. Facets are laid out on a
+    subplot grid, with the rows of each facet located in a single groupby pass.
+    Labels follow the plotly express conventions.
+
+    Args:
+        columns: mapping of column name to column data.
+        x: column name to treat as x coordinates of trace(s).
+        y: column name(s) to treat as y coordinates of trace(s).
+        mode: trace drawing mode.
+        fc: column name to treat as facet column of trace(s).
+        fr: column name to treat as facet row of trace(s).
+        x_error: column name to treat as x error of trace(s).
+        y_error: column name to treat as y error of trace(s).
+        title: title of plot.
+        template: name of the figure template.
+        max_points: maximum number of points per trace. None keeps all points.
+
+    Returns:
+        figure object.
+
+    """
+    ys = [y] if isinstance(y, str) else list(y)
+    multiple = len(ys) > 1
+    y_title = "value" if multiple else ys[0]
+
+    layout = dict(
+        _base_layout(template or pio.templates.default),
+        title=title,
+        legend_title_text="variable" if multiple else None,
     )
 
-    # x and y-axis formatting
-    fig_styled.update_yaxes(
-        showline=True,  # add line at x=0
-        linecolor="black",  # line color
-        linewidth=2.4,  # line size
-        ticks="outside",  # ticks outside axis
-        tickfont=font_dict,  # tick label font
-        mirror="allticks",  # add ticks to top/right axes
-        tickwidth=2.4,  # tick width
-        tickcolor="black",  # tick color
+    if fc is None and fr is None:
+        traces = _xy_traces(
+            columns=columns,
+            x=x,
+            ys=ys,
+            mode=mode,
+            x_error=x_error,
+            y_error=y_error,
+            max_points=max_points,
+            showlegend=multiple,
+        )
+        return go.Figure(
+            data=traces, layout=dict(layout, xaxis_title=x, yaxis_title=y_title)
+        )
+
+    # facet values in order of appearance, as in plotly express
+    row_values = [None] if fr is None else pd.unique(columns[fr])
+    col_values = [None] if fc is None else pd.unique(columns[fc])
+    row_positions = {value: i for i, value in enumerate(row_values)}
+    col_positions = {value: i for i, value in enumerate(col_values)}
+
+    keys = [key for key in (fr, fc) if key is not None]
+    groups = (
+        pd.DataFrame(data={key: columns[key] for key in keys}, copy=False)
+        .groupby(keys if len(keys) > 1 else keys[0], sort=False, observed=True)
+        .indices
     )
 
-    fig_styled.update_xaxes(
-        showline=True,
-        showticklabels=True,
-        linecolor="black",
-        linewidth=2.4,
-        ticks="outside",
-        tickfont=font_dict,
-        mirror="allticks",
-        tickwidth=2.4,
-        tickcolor="black",
+    # traces of the same column share a color across facets
+    colorway = layout.get("template", {}).get("layout", {}).get("colorway")
+
+    traces, rows, cols = [], [], []
+    for i, (key, index) in enumerate(groups.items()):
+        key = key if isinstance(key, tuple) else (key,)
+        row = row_positions[key[0]] if fr is not None else 0
+        col = col_positions[key[-1]] if fc is not None else 0
+
+        group_traces = _xy_traces(
+            columns={
+                name: columns[name][index] for name in _names(x, ys, x_error, y_error)
+            },
+            x=x,
+            ys=ys,
+            mode=mode,
+            x_error=x_error,
+            y_error=y_error,
+            max_points=max_points,
+            colors=colorway,
+            showlegend=multiple and i == 0,
+        )
+        traces.extend(group_traces)
+        rows.extend([row + 1] * len(group_traces))
+        cols.extend([col + 1] * len(group_traces))
+
+    fig = make_subplots(
+        rows=len(row_values),
+        cols=len(col_values),
+        shared_xaxes="all",
+        shared_yaxes="all",
+        horizontal_spacing=0.02,
+        vertical_spacing=0.03,
+        row_titles=None if fr is None else [f"{fr}={v}" for v in row_values],
+        column_titles=None if fc is None else [f"{fc}={v}" for v in col_values],
+        x_title=x,
+        y_title=y_title,
+        figure=go.Figure(layout=layout),
     )
+    fig.add_traces(data=traces, rows=rows, cols=cols)
 
-    return fig_styled
+    return fig
 
 
 def line(
-    df: pd.DataFrame,
+    df,
     x: str,
     y: str | list[str],
     fc: str = None,
@@ -73,6 +465,7 @@ def line(
     title: str = None,
     show: bool = False,
     dark: bool = False,
+    max_points: int = 10_000,
 ):
     """Plots a line plot.
 
@@ -84,7 +477,8 @@ def line(
     as the value of the variable at the facets will not be rendered. Only supports one
     set of error data across all traces.
     Args:
-        df: dataframe containing x and y data down columns.
+        df: dataframe containing x and y data down columns. Besides pandas, any
+            dataframe implementing the dataframe interchange protocol is accepted.
         x: column name to treat as x coordinates of trace(s).
         y: column name(s) to treat as y coordinates of trace(s).
         fc: column name to treat as facet column of trace(s).
@@ -95,6 +489,9 @@ def line(
         title: title of plot.
         show: whether to show plot.
         dark: plot in dark mode.
+        max_points: maximum number of points per trace. Longer traces are
+            downsampled using the largest-triangle-three-buckets algorithm, which
+            preserves their visual shape. None keeps all points.
     Returns:
         figure object.
 
@@ -102,17 +499,20 @@ def line(
 
     template = "plotly_dark" if dark else "plotly"
 
-    fig = px.line(
-        data_frame=df,
+    names = _names(x, y, fc, fr, x_error, y_error)
+
+    fig = _xy_figure(
+        columns=_extract_columns(df=df, names=names),
         x=x,
         y=y,
+        mode="lines+markers" if markers else "lines",
+        fc=fc,
+        fr=fr,
+        x_error=x_error,
+        y_error=y_error,
         title=title,
-        error_x=x_error,
-        error_y=y_error,
-        markers=markers,
-        facet_col=fc,
-        facet_row=fr,
         template=template,
+        max_points=max_points,
     )
 
     if show:
@@ -122,7 +522,7 @@ def line(
 
 
 def scatter(
-    df: pd.DataFrame,
+    df,
     x: str,
     y: str | list[str],
     c: str = None,
@@ -145,7 +545,8 @@ def scatter(
     set of error data across all traces.
 
     Args:
-        df: dataframe containing x and y data down columns.
+        df: dataframe containing x and y data down columns. Besides pandas, any
+            dataframe implementing the dataframe interchange protocol is accepted.
         x: column name to treat as x coordinates of trace(s).
         y: column name(s) to treat as y coordinates of trace(s).
         c: column name to treat as color of trace(s).
@@ -163,19 +564,36 @@ def scatter(
 
     """
 
-    fig = px.scatter(
-        data_frame=df,
-        x=x,
-        y=y,
-        color=c,
-        symbol=m,
-        size=s,
-        title=title,
-        error_x=x_error,
-        error_y=y_error,
-        facet_col=fc,
-        facet_row=fr,
-    )
+    names = _names(x, y, c, s, m, fc, fr, x_error, y_error)
+
+    if all(arg is None for arg in (c, s, m)):
+        fig = _xy_figure(
+            columns=_extract_columns(df=df, names=names),
+            x=x,
+            y=y,
+            mode="markers",
+            fc=fc,
+            fr=fr,
+            x_error=x_error,
+            y_error=y_error,
+            title=title,
+        )
+    else:
+        data_frame = _to_pandas(df=df, names=names)
+        fig = px.scatter(
+            data_frame=data_frame,
+            x=x,
+            y=y,
+            color=c,
+            symbol=m,
+            size=s,
+            title=title,
+            error_x=x_error,
+            error_y=y_error,
+            facet_col=fc,
+            facet_row=fr,
+            render_mode=_render_mode(data_frame),
+        )
 
     if show:
         fig.show()
@@ -184,7 +602,7 @@ def scatter(
 
 
 def scatter3(
-    df: pd.DataFrame,
+    df,
     x: str,
     y: str,
     z: str | list[str],
@@ -200,7 +618,8 @@ def scatter3(
     """Plots 3D scatter plot. Supports up to 6D data.
 
     Args:
-        df: dataframe containing x and y data down columns.
+        df: dataframe containing x and y data down columns. Besides pandas, any
+            dataframe implementing the dataframe interchange protocol is accepted.
         x: column name to treat as x coordinates of trace(s).
         y: column name(s) to treat as y coordinates of trace(s).
         z: column name to treat as z coordinates of trace(s).
@@ -217,8 +636,10 @@ def scatter3(
         figure object.
 
     """
+    names = _names(x, y, z, c, s, m, x_error, y_error, z_error)
+
     fig = px.scatter_3d(
-        data_frame=df,
+        data_frame=_to_pandas(df=df, names=names),
         x=x,
         y=y,
         z=z,
@@ -246,9 +667,13 @@ def surface(
     title_y: str = None,
     title_z: str = None,
     show: bool = False,
+    mode: Literal["surface", "heatmap"] = "surface",
 ):
     """Plots surface data. Supports up to 3D data.
 
+    The heatmap mode draws the data as a flat 2D heatmap, which is far cheaper to
+    render than a 3D surface for large grids.
+
     Args:
         x: x-coordinate data.
         y: y-coordinate data.
@@ -256,24 +681,33 @@ def surface(
         title: title of plot.
         title_x: title of x-axis.
         title_y: title of y-axis.
-        title_z: title of z-axis.
+        title_z: title of z-axis, used as the colorbar title in heatmap mode.
         show: whether to show plot.
+        mode: either "surface" for a 3D surface or "heatmap" for a 2D heatmap.
 
     Returns:
         figure object.
 
     """
-    fig = go.Figure(data=[go.Surface(z=z, x=x, y=y)])
+    if mode == "surface":
+        fig = go.Figure(data=[go.Surface(z=z, x=x, y=y)])
 
-    fig.update_traces(
-        contours_z=dict(
-            show=True, usecolormap=True, highlightcolor="limegreen", project_z=True
+        fig.update_traces(
+            contours_z=dict(
+                show=True, usecolormap=True, highlightcolor="limegreen", project_z=True
+            )
         )
-    )
-    fig.update_layout(
-        title=title,
-        scene=dict(xaxis_title=title_x, yaxis_title=title_y, zaxis_title=title_z),
-    )
+        fig.update_layout(
+            title=title,
+            scene=dict(xaxis_title=title_x, yaxis_title=title_y, zaxis_title=title_z),
+        )
+    elif mode == "heatmap":
+        fig = go.Figure(
+            data=[go.Heatmap(z=z, x=x, y=y, colorbar=dict(title=title_z))],
+            layout=go.Layout(title=title, xaxis_title=title_x, yaxis_title=title_y),
+        )
+    else:
+        raise ValueError(f"Unknown surface mode: {mode}")
 
     if show:
         fig.show()
@@ -281,25 +715,65 @@ def surface(
     return fig
 
 
-def save(fig, name: str, path: Path):
-    """Saves figure as an HTML to the output path.
+def _write_gzip(filepath: Path, content: bytes):
+    """Writes content to a gzip compressed file.
+
+    Args:
+        filepath: path of the file.
+        content: data to be compressed and written.
+
+    """
+    try:
+        try:
+            file = gzip.open(filepath, "wb", compresslevel=1)
+        except FileNotFoundError:
+            # the directory was removed after it was first ensured by save
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            file = gzip.open(filepath, "wb", compresslevel=1)
+
+        with file:
+            file.write(content)
+    except Exception:
+        LOG.exception(f"Failed to save figure to {filepath}")
+        raise
+
+    LOG.info(f"Saved figure to {filepath}")
+
+
+def save(fig, name: str, path: Path, wait: bool = False):
+    """Saves figure as a gzip compressed HTML to the output path.
+
+    The figure is serialized immediately, but compressed and written to disk in a
+    background thread so that the caller can carry on while the file is written.
+    Failed background writes are logged. plotly.js is loaded from a CDN rather than
+    embedded in the file.
 
     Args:
         fig: figure object.
         name: file name without extensions.
         path: directory in which to save the figure.
+        wait: whether to wait for the file to be written, raising any error that
+            occurred while writing it.
 
     Returns:
-        Saved filepath.
+        Saved filepath. Unless waiting, the file may still be being written when
+        returned.
 
     """
-    path.mkdir(parents=True, exist_ok=True)
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
+    if path not in _ENSURED_DIRS:
+        path.mkdir(parents=True, exist_ok=True)
+        _ENSURED_DIRS.add(path)
 
-    filepath = path / f"{name}_{timestamp}.html"
+    suffix = f"{_SAVE_PREFIX}_{next(_SAVE_COUNTER):06d}"
 
-    fig.write_html(filepath, include_mathjax="cdn")
+    filepath = path / f"{name}_{suffix}.html.gz"
 
-    LOG.info(f"Saved figure to {filepath}")
+    # plotly serializes trace arrays with orjson straight from the numpy buffers
+    # when it is installed, which is an order of magnitude faster than stdlib json
+    html = pio.to_html(fig, include_mathjax="cdn", include_plotlyjs="cdn")
+    future = _SAVE_EXECUTOR.submit(_write_gzip, filepath, html.encode())
+
+    if wait:
+        future.result()
 
     return filepath
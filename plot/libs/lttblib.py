@@ -0,0 +1,184 @@
+"""Downsampling of series for display."""
+# stdlib
+import functools
+
+# external
+import numpy as np
+
+
+def _lttb_numpy(x: np.ndarray, y: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Largest-triangle-three-buckets kernel vectorized over each bucket.
+
+    Args:
+        x: x-coordinates of the series.
+        y: y-coordinates of the series.
+        edges: bucket edges of the inner points, followed by the series length.
+
+    Returns:
+        Indices of the selected points.
+
+    """
+    n_out = edges.size
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = x.size - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_start, next_stop = edges[i + 1], edges[i + 2]
+
+        c_x = x[next_start:next_stop].mean()
+        c_y = y[next_start:next_stop].mean()
+
+        area = np.abs(
+            (x[a] - c_x) * (y[start:stop] - y[a])
+            - (x[a] - x[start:stop]) * (c_y - y[a])
+        )
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+
+    return indices
+
+
+def _lttb_loop(x: np.ndarray, y: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """Largest-triangle-three-buckets kernel written as plain loops for numba.
+
+    Args:
+        x: x-coordinates of the series.
+        y: y-coordinates of the series.
+        edges: bucket edges of the inner points, followed by the series length.
+
+    Returns:
+        Indices of the selected points.
+
+    """
+    n_out = edges.size
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = x.size - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_start, next_stop = edges[i + 1], edges[i + 2]
+
+        c_x = 0.0
+        c_y = 0.0
+        for j in range(next_start, next_stop):
+            c_x += x[j]
+            c_y += y[j]
+        c_x /= next_stop - next_start
+        c_y /= next_stop - next_start
+
+        area_max = -1.0
+        selected = start
+        for j in range(start, stop):
+            area = abs((x[a] - c_x) * (y[j] - y[a]) - (x[a] - x[j]) * (c_y - y[a]))
+            if area > area_max:
+                area_max = area
+                selected = j
+
+        a = selected
+        indices[i + 1] = a
+
+    return indices
+
+
+@functools.cache
+def _lttb_kernel():
+    """Selects the largest-triangle-three-buckets kernel.
+
+    The loop kernel is compiled with numba when it is installed, otherwise the numpy
+    kernel is used. Deferred to the first downsampling since importing numba takes
+    longer than importing the rest of the library.
+
+    Returns:
+        The kernel function.
+
+    """
+    try:
+        # external
+        import numba  # pylint: disable=import-outside-toplevel
+    except ImportError:  # optional dependency
+        return _lttb_numpy
+
+    return numba.njit(cache=True, fastmath=True, boundscheck=False)(_lttb_loop)
+
+
+def _lttb_runs(
+    x: np.ndarray, y: np.ndarray, finite: np.ndarray, n_out: int
+) -> np.ndarray:
+    """Downsample each run of finite points of a series separately.
+
+    Args:
+        x: x-coordinates of the series.
+        y: y-coordinates of the series.
+        finite: whether each point has finite coordinates.
+        n_out: number of points to keep, shared among the runs by their length.
+
+    Returns:
+        Indices of the selected points, with the non-finite point preceding each run
+        but the first separating it from the previous run.
+
+    """
+    starts = np.flatnonzero(finite & ~np.concatenate(([False], finite[:-1])))
+    stops = np.flatnonzero(finite & ~np.concatenate((finite[1:], [False]))) + 1
+
+    # the points left after the separators are shared in proportion to run length
+    lengths = stops - starts
+    n_free = max(n_out - (starts.size - 1), 0)
+    n_outs = np.maximum(lengths * n_free // max(lengths.sum(), 1), 3)
+
+    indices = []
+    for start, stop, n_run_out in zip(starts, stops, n_outs):
+        if indices:
+            indices.append([start - 1])  # separator
+
+        run = lttb(x=x[start:stop], y=y[start:stop], n_out=int(n_run_out))
+        indices.append(start + run)
+
+    return np.concatenate(indices) if indices else np.empty(0, dtype=np.int64)
+
+
+def lttb(x, y, n_out: int) -> np.ndarray:
+    """Downsample a series using the largest-triangle-three-buckets algorithm.
+
+    The first and last points are always kept. The points in between are split into
+    n_out - 2 buckets, from each of which the point forming the largest triangle with
+    the previously selected point and the average of the next bucket is selected.
+    This preserves the visual shape of the series far better than decimation. The
+    kernel is compiled with numba when it is installed. Runs of finite points are
+    downsampled separately and separated by a non-finite point, so that gaps in the
+    series are kept. Every run keeps at least 3 of its points, so series with many
+    gaps may keep more than n_out points.
+
+    Args:
+        x: x-coordinates of the series, sorted in ascending order.
+        y: y-coordinates of the series.
+        n_out: number of points to keep.
+
+    Returns:
+        Indices of the selected points.
+
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    y = np.ascontiguousarray(y, dtype=np.float64)
+
+    # non-finite points are left out of the kernel, which also keeps the fastmath
+    # kernel well defined
+    finite = np.isfinite(x) & np.isfinite(y)
+    if not finite.all():
+        return _lttb_runs(x=x, y=y, finite=finite, n_out=n_out)
+
+    # bucket edges of the inner points, followed by a final bucket holding only the
+    # last point so that every inner bucket has a next bucket to look ahead to
+    edges = np.empty(n_out, dtype=np.int64)
+    edges[:-1] = np.linspace(start=1, stop=n - 1, num=n_out - 1)
+    edges[-1] = n
+
+    return _lttb_kernel()(x, y, edges)
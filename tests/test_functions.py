@@ -1,14 +1,18 @@
 """Tests for the plot library."""
 
 # stdlib
+import gzip
 import logging
 import math
+import multiprocessing
+import shutil
 from pathlib import Path
 
 # external
 import numpy as np
 import pandas as pd
-from pandas import DataFrame
+import plotly.io as pio
+import pyarrow as pa
 
 # project
 import plot
@@ -17,6 +21,27 @@ from plot.libs import utillib
 LOG = logging.getLogger(__name__)
 
 
+def to_table(**columns) -> pa.Table:
+    """Collect broadcasted arrays into the columns of a float32 arrow table.
+
+    Each array is materialized exactly once, directly as a contiguous float32
+    column, and handed to arrow without further copies.
+
+    Args:
+        columns: arrays keyed by column name.
+
+    Returns:
+        Table with one column per array.
+
+    """
+    return pa.table(
+        {
+            name: np.ascontiguousarray(array, dtype=np.float32).ravel()
+            for name, array in columns.items()
+        }
+    )
+
+
 def test_line():
     """Test the line plot function with full dimensionality."""
 
@@ -39,8 +64,7 @@ def test_line():
     # endregion
 
     # region plot
-    dfd = {"x": x.flatten(), "y": y.flatten(), "a": a.flatten(), "b": b.flatten()}
-    df = pd.DataFrame(data=dfd)
+    df = to_table(x=x, y=y, a=a, b=b)
     LOG.debug(df)
 
     plot.line(
@@ -54,13 +78,96 @@ def test_line():
     # endregion
 
 
+def test_line_facets():
+    """Test the placement, titles and colors of faceted line plot traces."""
+
+    # region parameters
+    x = np.linspace(start=0, stop=1, num=8)
+    a = np.array([2.0, 1.0])  # facet column values, not in sorted order
+    b = np.array([3.0, 1.0, 2.0])  # facet row values, not in sorted order
+    # endregion
+
+    # region broadcasting
+    shape = (a.size, b.size, x.size)
+
+    a = utillib.orient_and_broadcast(a=a, dim=0, shape=shape)
+    b = utillib.orient_and_broadcast(a=b, dim=1, shape=shape)
+    x = utillib.orient_and_broadcast(a=x, dim=2, shape=shape)
+    # endregion
+
+    # region evaluation
+    y1 = 10 * a + b + 0 * x  # identifies the facet of each trace
+    y2 = -y1
+    # endregion
+
+    # region plot
+    df = to_table(x=x, y1=y1, y2=y2, a=a, b=b)
+    LOG.debug(df)
+
+    fig = plot.line(df=df, x="x", y=["y1", "y2"], fc="a", fr="b")
+    # endregion
+
+    # region checks
+    rows = [3.0, 1.0, 2.0]  # order of first occurrence
+    cols = [2.0, 1.0]
+
+    annotations = [annotation.text for annotation in fig.layout.annotations]
+    assert annotations[: len(cols)] == [f"a={v}" for v in cols]
+    assert annotations[len(cols) : len(cols) + len(rows)] == [f"b={v}" for v in rows]
+
+    assert len(fig.data) == 2 * len(rows) * len(cols)
+    for trace in fig.data:
+        sign = 1 if trace.name == "y1" else -1
+        col_value, row_value = divmod(sign * trace.y[0], 10)
+        subplot = rows.index(row_value) * len(cols) + cols.index(col_value) + 1
+        suffix = "" if subplot == 1 else str(subplot)
+        assert (trace.xaxis, trace.yaxis) == (f"x{suffix}", f"y{suffix}")
+
+    for name in ("y1", "y2"):
+        traces = [trace for trace in fig.data if trace.name == name]
+        assert len({trace.line.color for trace in traces}) == 1
+        assert sum(bool(trace.showlegend) for trace in traces) == 1
+    assert fig.data[0].line.color != fig.data[1].line.color
+    # endregion
+
+
+def test_scatter_facets_without_colorway(monkeypatch):
+    """Test faceted plots under default templates that define no colorway."""
+
+    x = np.tile(np.linspace(start=0, stop=1, num=8), 2)
+    a = np.repeat([1.0, 2.0], 8)
+
+    df = pa.table({"x": x, "y": a * x, "a": a})
+    LOG.debug(df)
+
+    for template in ("none", "presentation"):
+        monkeypatch.setattr(pio.templates, "default", template)
+
+        fig = plot.scatter(df=df, x="x", y="y", fc="a")
+
+        assert len(fig.data) == 2
+
+
+def test_line_template_changes(monkeypatch):
+    """Test that changes to a registered template reach later plots."""
+
+    df = pa.table({"x": [1.0, 2.0, 3.0], "y": [1.0, 4.0, 9.0]})
+    LOG.debug(df)
+
+    plot.line(df=df, x="x", y="y")
+    monkeypatch.setattr(pio.templates["plotly"].layout.font, "size", 30)
+    fig = plot.line(df=df, x="x", y="y")
+
+    assert fig.layout.template.layout.font.size == 30
+
+
 def test_style_to_matplotlib():
     """Test the style to matplotlib method."""
 
     x = np.arange(start=0, stop=2 * math.pi, step=0.1)
     y = np.sin(x)
 
-    df = DataFrame({"x": x.flatten(), "y": y.flatten()})
+    df = pa.table({"x": x, "y": y})
     LOG.debug(df)
 
     fig = plot.line(
@@ -70,7 +177,30 @@ def test_style_to_matplotlib():
         title="Test Line Plot Matplotlib Style",
     )
 
-    plot.style_to_matplotlib(fig)
+    fig_styled = plot.style_to_matplotlib(fig)
+    assert fig_styled is not fig
+
+    fig_styled = plot.style_to_matplotlib(fig, inplace=True)
+    assert fig_styled is fig
+
+
+def test_style_to_matplotlib_facets():
+    """Test that the matplotlib style reaches every axis of a faceted figure."""
+
+    x = np.tile(np.linspace(start=0, stop=1, num=16), 4)
+    a = np.repeat([1.0, 2.0], 32)
+    b = np.tile(np.repeat([1.0, 2.0], 16), 2)
+
+    df = pa.table({"x": x, "y": a * x + b, "a": a, "b": b})
+    LOG.debug(df)
+
+    fig = plot.line(df=df, x="x", y="y", fc="a", fr="b")
+    fig_styled = plot.style_to_matplotlib(fig)
+
+    for axis in fig_styled.select_xaxes():
+        assert axis.showticklabels and axis.showline
+    for axis in fig_styled.select_yaxes():
+        assert axis.showline and axis.linecolor == "black"
 
 
 def test_line_multiple_traces():
@@ -84,13 +214,13 @@ def test_line_multiple_traces():
     y1 = np.sin(x)
     y2 = np.cos(x)
 
-    x_error = 0.05
+    x_error = np.full_like(x, 0.05)
     y_error = (y1 + y2) * 0.05
     # endregion
 
     # region plot
     dfd = {"$x$": x, "$y_1$": y1, "$y_2$": y2, "x_error": x_error, "y_error": y_error}
-    df = pd.DataFrame(data=dfd)
+    df = pa.table(dfd)
     LOG.debug(df)
 
     plot.line(
@@ -104,6 +234,78 @@ def test_line_multiple_traces():
     # endregion
 
 
+def test_line_pandas():
+    """Test the line plot function with a pandas dataframe."""
+
+    # region parameters
+    x = np.linspace(start=-math.pi, stop=math.pi, num=64)
+    # endregion
+
+    # region evaluation
+    y = np.sin(x)
+    # endregion
+
+    # region plot
+    df = pd.DataFrame(data={"x": x, "y": y, "unused": np.zeros_like(x)})
+    LOG.debug(df)
+
+    fig = plot.line(df=df, x="x", y="y", title="Test Line Plot From Pandas")
+
+    assert np.array_equal(fig.data[0].y, y)
+    # endregion
+
+
+def test_line_downsampling():
+    """Test the line plot function with a trace exceeding the maximum point count."""
+
+    # region parameters
+    x = np.linspace(start=0, stop=100 * math.pi, num=100_000)
+    # endregion
+
+    # region evaluation
+    y = np.sin(x) * np.exp(-x * 0.01)
+    # endregion
+
+    # region plot
+    df = pa.table({"x": x, "y": y})
+    LOG.debug(df)
+
+    fig = plot.line(
+        df=df, x="x", y="y", max_points=1000, title="Test Line Plot Downsampling"
+    )
+
+    assert len(fig.data[0].x) == 1000
+    assert fig.data[0].x[0] == x[0] and fig.data[0].x[-1] == x[-1]
+    # endregion
+
+
+def test_line_downsampling_gaps():
+    """Test that downsampling keeps the gaps of a trace with non-finite values."""
+
+    # region parameters
+    x = np.linspace(start=0, stop=100 * math.pi, num=20_000)
+    # endregion
+
+    # region evaluation
+    y = np.sin(x)
+    y[5000:6000] = np.nan
+    # endregion
+
+    # region plot
+    df = pa.table({"x": x, "y": y})
+    LOG.debug(df)
+
+    fig = plot.line(df=df, x="x", y="y", title="Test Line Plot Downsampling Gaps")
+
+    x_plot, y_plot = np.asarray(fig.data[0].x), np.asarray(fig.data[0].y)
+    gap = np.flatnonzero(np.isnan(y_plot))
+
+    assert len(x_plot) <= 10_000
+    assert gap.size == 1
+    assert x_plot[gap[0] - 1] < x[5000] and x_plot[gap[0] + 1] > x[5999]
+    # endregion
+
+
 def test_scatter():
     """Test the scatter plot function with full dimensionality."""
 
@@ -128,20 +330,11 @@ def test_scatter():
     # endregion
 
     # region evaluate
-    y = a * x**4 + b * x**3 + c * x**2 + d * x + e
+    y = (((a * x + b) * x + c) * x + d) * x + e  # horner's scheme
     # endregion
 
     # region plot
-    dfd = {
-        "x": x.flatten(),
-        "y": y.flatten(),
-        "a": a.flatten(),
-        "b": b.flatten(),
-        "c": c.flatten(),
-        "d": d.flatten(),
-        "e": e.flatten(),
-    }
-    df = pd.DataFrame(data=dfd)
+    df = to_table(x=x, y=y, a=a, b=b, c=c, d=d, e=e)
     LOG.debug(df)
 
     plot.scatter(
@@ -158,6 +351,23 @@ def test_scatter():
     # endregion
 
 
+def test_scatter_render_mode():
+    """Test that traces above the WebGL threshold are rendered with WebGL."""
+
+    for n, trace_type in (
+        (plot.WEBGL_THRESHOLD, "scatter"),
+        (plot.WEBGL_THRESHOLD + 1, "scattergl"),
+    ):
+        x = np.linspace(start=0, stop=1, num=n)
+        df = to_table(x=x, y=x**2, c=x)
+
+        fig = plot.scatter(df=df, x="x", y="y")
+        assert [trace.type for trace in fig.data] == [trace_type]
+
+        fig = plot.scatter(df=df, x="x", y="y", c="c")  # plotly express
+        assert [trace.type for trace in fig.data] == [trace_type]
+
+
 def test_scatter3():
     """Test the scatter3 plot function with full dimensionality."""
 
@@ -184,15 +394,7 @@ def test_scatter3():
     # endregion
 
     # region plot
-    dfd = {
-        "x": x.flatten(),
-        "y": y.flatten(),
-        "z": z.flatten(),
-        "a": a.flatten(),
-        "b": b.flatten(),
-        "c": c.flatten(),
-    }
-    df = pd.DataFrame(data=dfd)
+    df = to_table(x=x, y=y, z=z, a=a, b=b, c=c)
     LOG.debug(df)
 
     plot.scatter3(
@@ -223,9 +425,8 @@ def test_surface():
     # endregion
 
     # region evaluation
-    z = np.cos(np.sqrt(x_broad**2 + y_broad**2)) / np.exp(
-        (x_broad**2 + y_broad**2) * 0.001
-    )
+    r2 = x_broad**2 + y_broad**2
+    z = np.cos(np.sqrt(r2)) / np.exp(r2 * 0.001)
     LOG.debug(z)
     # endregion
 
@@ -242,6 +443,34 @@ def test_surface():
     # endregion
 
 
+def test_surface_heatmap():
+    """Test the surface plot function in heatmap mode."""
+    # region parameters
+    x = np.linspace(start=-5, stop=5, num=64)
+    y = np.linspace(start=-5, stop=5, num=64)
+    # endregion
+
+    # region evaluation
+    z = np.sin(x[None, :]) * np.cos(y[:, None])
+    LOG.debug(z)
+    # endregion
+
+    # region plot
+    fig = plot.surface(
+        x=x,
+        y=y,
+        z=z,
+        title="Test Surface Heatmap Plot",
+        title_x="x",
+        title_y="y",
+        title_z="z",
+        mode="heatmap",
+    )
+
+    assert fig.data[0].type == "heatmap"
+    # endregion
+
+
 def test_save():
     """Test the figure save function."""
 
@@ -255,9 +484,58 @@ def test_save():
 
     # region plot
     dfd = {"$x$": x, "$y$": y}
-    df = pd.DataFrame(data=dfd)
+    df = pa.table(dfd)
     LOG.debug(df)
 
     fig = plot.line(df=df, x="$x$", y="$y$", title="Test line plot for saving")
-    plot.save(fig=fig, name="save_test_img", path=Path("output/test/img/"))
+    filepath = plot.save(
+        fig=fig, name="save_test_img", path=Path("output/test/img/"), wait=True
+    )
+
+    with gzip.open(filepath, "rt", encoding="utf-8") as file:
+        assert file.read().startswith("<html>")
+    # endregion
+
+
+def test_save_removed_directory(tmp_path):
+    """Test that saving recreates a directory removed after a previous save."""
+
+    # region plot
+    df = pa.table({"$x$": [1, 2, 3], "$y$": [1, 2, 3]})
+    fig = plot.line(df=df, x="$x$", y="$y$", title="Test line plot for saving")
+
+    path = tmp_path / "img"
+    plot.save(fig=fig, name="save_test_img", path=path, wait=True)
+    shutil.rmtree(path)
+    filepath = plot.save(fig=fig, name="save_test_img", path=path, wait=True)
+
+    assert filepath.is_file()
+    # endregion
+
+
+def _save_in_child(path: Path) -> Path:
+    """Saves a figure from a worker process."""
+    df = pa.table({"$x$": [1, 2, 3], "$y$": [1, 2, 3]})
+    fig = plot.line(df=df, x="$x$", y="$y$", title="Test line plot for saving")
+
+    return plot.save(fig=fig, name="save_test_img", path=path, wait=True)
+
+
+def test_save_forked(tmp_path):
+    """Test saving from processes forked after the parent has saved."""
+
+    # region plot
+    filepath = _save_in_child(path=tmp_path)
+
+    # each task runs in a separate child, forked from the same parent state
+    with multiprocessing.get_context("fork").Pool(
+        processes=2, maxtasksperchild=1
+    ) as pool:
+        results = [pool.apply_async(_save_in_child, (tmp_path,)) for _ in range(2)]
+        filepaths = [result.get(timeout=20) for result in results]
+
+    assert len({filepath, *filepaths}) == 3
+    for filepath_child in filepaths:
+        with gzip.open(filepath_child, "rt", encoding="utf-8") as file:
+            assert file.read().startswith("<html>")
     # endregion
@@ -0,0 +1,34 @@
+"""Tests for the downsampling library."""
+
+# external
+import numpy as np
+
+# project
+from plot.libs import lttblib
+
+
+def test_lttb_kernels(monkeypatch):
+    """Test that the compiled and numpy kernels select the same points."""
+
+    # region parameters
+    rng = np.random.default_rng(seed=0)
+    x = np.sort(rng.uniform(low=0, high=100, size=10_000))
+    y = rng.normal(size=x.size)
+    y_nan = y.copy()
+    y_nan[rng.choice(a=x.size, size=5, replace=False)] = np.nan
+    # endregion
+
+    # region evaluation
+    indices = [lttblib.lttb(x=x, y=y_test, n_out=500) for y_test in (y, y_nan)]
+
+    monkeypatch.setattr(lttblib, "_lttb_kernel", lambda: lttblib._lttb_numpy)
+    indices_numpy = [lttblib.lttb(x=x, y=y_test, n_out=500) for y_test in (y, y_nan)]
+    # endregion
+
+    # region checks
+    for i, i_numpy in zip(indices, indices_numpy):
+        assert np.array_equal(i, i_numpy)
+
+    assert indices[0].size == 500
+    assert np.isnan(y_nan[indices[1]]).sum() <= 5
+    # endregion